@@ -0,0 +1,128 @@
+# cython: language_level=3
+"""Compiled hot paths of bbcodeparser. BBCodeParser here subclasses the pure
+Python parser, so tag_re and everything not overridden is shared with it.
+Build with
+    python setup.py build_ext --inplace
+and check it against the pure Python build with differential.py."""
+from itertools import chain
+from collections import deque
+
+import bbcodeparser
+
+
+class BBCodeParser(bbcodeparser.BBCodeParser):
+    def parse_tags(self, target, exclude=()):
+        """Typed version of bbcodeparser.BBCodeParser.parse_tags"""
+        cdef Py_ssize_t i, size
+        cdef int level = 0
+
+        chop = self.tag_re.split(target)
+        size = len(chop)
+
+        Tag = self.Tag
+        valid_bbcode = self.valid_bbcode
+        outer = []
+
+        # re.split produces text in groups of 7, the last text on its own
+        for i in range(0, size, 6):
+            t = chop[i]
+            if t and not level:
+                outer.append(t)
+
+            if i + 1 == size:
+                break
+
+            full = chop[i + 1]
+            name = chop[i + 3]
+
+            if name is None:
+                outer.append(full)
+                continue
+
+            name = name.lower()
+            if name in valid_bbcode:
+                close = chop[i + 2]
+                if name in exclude:
+                    if not close:
+                        level += 1
+                        continue
+                    elif level:
+                        level -= 1
+                        continue
+
+                if not level:
+                    outer.append(Tag(full, close, name, chop[i + 5]))
+            elif not level:
+                outer.append(full)
+
+        return outer
+
+
+    def index_tag_pairs(self, target, tags):
+        """Typed version of bbcodeparser.BBCodeParser.index_tag_pairs"""
+        cdef Py_ssize_t start = 0, n
+        cdef int level = 0, prev = 0
+
+        tags = set(tags)
+        Tag = self.Tag
+        output = []
+
+        for n, tag in enumerate(target):
+            if isinstance(tag, Tag) and tag.name in tags:
+                level += -1 if tag.close else 1
+                level = max(0, level)
+
+                if prev == 0 and level == 1:
+                    start = n
+
+                elif prev == 1 and level == 0:
+                    output.append((start, n))
+
+                prev = level
+
+        return output
+
+
+    def line_extract(self, target, condition, ignore_ranges=[], max_lines=0):
+        """Typed version of bbcodeparser.BBCodeParser.line_extract"""
+        cdef Py_ssize_t s = -1, n, lower, upper
+        cdef Py_ssize_t count = 0, limit = max_lines
+
+        lines, plain_lines = deque(), deque()
+
+        plain_rep = ""
+        bbcode_rep = deque()
+
+        range_gen = self.range_generator(ignore_ranges)
+        lower, upper = next(range_gen)
+
+        for n, node in enumerate(target):
+            if node == '\n':
+                if condition(plain_rep):
+                    plain_lines.append(plain_rep)
+                    lines.append(bbcode_rep)
+                    count += 1
+
+                    if s == -1:
+                        s = n
+
+                    if count == limit:
+                        break
+
+                plain_rep = ""
+                bbcode_rep = deque()
+
+            while n >= upper:
+                lower, upper = next(range_gen)
+
+            if n < lower:
+                bbcode_rep.append(node)
+                if type(node) is str:
+                    plain_rep += node
+
+        if not lines:
+            return None, None
+
+        lines[0].extendleft(self.open_all_closed(chain(*lines),target[s::-1]))
+
+        return list(lines), list(plain_lines)
@@ -4,6 +4,10 @@ from itertools import chain, zip_longest
 from collections import namedtuple, Counter, deque
 
 class BBCodeParser(object):
+    # Bump when parse_tags or line_extract output changes, so cached
+    # extraction results from older parsers are not reused
+    version = 1
+
     def __init__(self):
         self.tag_re = re.compile(
             r"("                                   # -Capture tag entire
@@ -12,7 +16,7 @@ class BBCodeParser(object):
             r"(/)?"                                # -Capture the closing tag /
             r"([^]\[=]*)"                          # -Capture tag name
             r"(?:=(?P<quote>['\"]?)"               # -Capture opening quotation
-            r"([^]\[]]*)"                          # -Capture tag attribute
+            r"([^]\[]*)"                           # -Capture tag attribute
             r"(?P=quote))?"                        # Closing quotation match
             r"\])"                                 # Closing square bracket
         )
@@ -33,7 +37,7 @@ class BBCodeParser(object):
         return zip_longest(*args, fillvalue=fillvalue)
 
 
-    def parse_tags(self, target):
+    def parse_tags(self, target, exclude=()):
         """Parses BBCode string into a list containing text and tags using the
         Tag object.
 
@@ -45,15 +49,21 @@ class BBCodeParser(object):
 
         For example,
         Tag(full='[font="Tahoma"]', close=None, name='font', value='Tahoma')
+
+        Can be fed a set of tag names to exclude. Everything wrapped by those
+        tags, the tags themselves included, is dropped as it is parsed, save
+        for newlines so that line boundaries are kept. Nesting is tracked, so
+        a quote inside a quote is dropped along with its parent.
         """
         chop = self.tag_re.split(target)
         chop = self.grouper(chop, 6)
 
         outer = deque()
+        level = 0
 
         # re.split produces text in groups of 7
         for t, full, close, name, _, value in chop:
-            if t:
+            if t and not level:
                 outer.append(t)
 
             if full:
@@ -64,8 +74,17 @@ class BBCodeParser(object):
                 else:
                     # Validate BBCode
                     if name in self.valid_bbcode:
-                        outer.append(self.Tag(full, close, name, value))
-                    else:
+                        if name in exclude:
+                            if not close:
+                                level += 1
+                                continue
+                            elif level:
+                                level -= 1
+                                continue
+
+                        if not level:
+                            outer.append(self.Tag(full, close, name, value))
+                    elif not level:
                         outer.append(full)
 
         return list(outer)
@@ -193,13 +212,14 @@ class BBCodeParser(object):
         yield current_start, current_stop
 
 
-    def line_extract(self, target, condition, ignore_ranges=[]):
+    def line_extract(self, target, condition, ignore_ranges=[], max_lines=0):
         """Expects a list as produced by parse_tags, extracts lines that fulfill
         condition, including all relevant BBCode, opens the tags. Returns two
         lists of lists of complete lines. One is parsed BBCode, the other is
         plaintext.
 
-        Can be fed a list of position pairs to ignore."""
+        Can be fed a list of position pairs to ignore, and a maximum number of
+        lines to extract, past which the rest of the target is skipped."""
         s = -1        
         lines, plain_lines = deque(), deque()
 
@@ -222,6 +242,9 @@ class BBCodeParser(object):
                     if s == -1:
                         s = n
 
+                    if len(lines) == max_lines:
+                        break
+
                 # clear line
                 plain_rep = ""
                 bbcode_rep = deque()
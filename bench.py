@@ -0,0 +1,444 @@
+"""Times each stage of a tally on a synthetic thread, for the pure Python
+parser and, if built, the compiled one. Can also save stage timings and peak
+memory on fixed corpora as a baseline, and compare against it, exiting
+non-zero on a regression.
+
+Timings are only comparable on the same host, so save the versioned baseline
+on the host that runs --compare, usually CI, and commit it. Comparing on
+another host or Python warns. Both modes need at least MIN_REPEAT runs in
+each of MIN_PROCESSES processes, as the spread of fewer does not reflect the
+noise.
+
+python bench.py --posts 2000 --repeat 5
+python bench.py --save-baseline
+python bench.py --compare --tolerance 0.25 --json
+python bench.py --calibrate
+"""
+import gc, os, re, sys, json, time, argparse, platform, statistics, tracemalloc
+import multiprocessing
+
+from itertools import chain
+
+import corpus
+import bbcodeparser
+from voteparser import VoteContainer
+
+try:
+    import _bbcodeparser
+except ImportError:
+    _bbcodeparser = None
+
+BASELINE_VERSION = 3
+MIN_REPEAT = 5
+MIN_PROCESSES = 3
+
+# Fixed corpora for baselines, (posts, seed, voters, config). Changing these
+# needs a new baseline.
+baseline_corpora = {
+    "small"       : (300, 1, None, {}),
+    "large"       : (3000, 2, None, {}),
+    "few_voters"  : (2000, 3, 40, {"refer_dir": 1}),
+    "break_lines" : (1000, 4, None, {"break_level": 2})
+}
+
+
+# Fixed work using no tally code, timed alongside the stages so that
+# comparisons can allow for the whole host running faster or slower
+reference_text = "\n".join(
+    "[b]Line {}[/b] with [i]some[/i] [color=red]markup[/color]".format(i)
+    for i in range(4000))
+
+
+def reference_workload():
+    tokens = re.split(r"(\[/?[a-z]+(?:=[^]]*)?\])", reference_text)
+    lines = [i.lower().strip() for i in tokens if i]
+    return len({line: n for n, line in enumerate(lines)})
+
+
+def time_reference():
+    gc.disable()
+    start = time.perf_counter()
+    reference_workload()
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    return elapsed
+
+
+def stages(VC, thread):
+    """Returns a list of (name, setup, run) for each stage of a tally. setup
+    builds fresh input for run, as the later stages modify votes in place."""
+    posts, op = thread['posts'], thread['op'].lower()
+    messages = [post['message'] for post in posts]
+    BB = VC.BBparse
+
+    def parsed():
+        return [BB.parse_tags(m, VC.rem_text) for m in messages]
+
+    def uniqed():
+        return list(VC.uniq_votes_by_name(VC.extract_votes(posts), op=op))
+
+    def merged():
+        return list(VC.merge_votes_by_content(uniqed()))
+
+    return [
+        ("parse_tags", lambda: messages,
+            lambda m: [BB.parse_tags(i, VC.rem_text) for i in m]),
+        ("line_extract", parsed,
+            lambda p: [BB.line_extract(i, VC.is_vote) for i in p]),
+        ("extract_votes", lambda: posts, VC.extract_votes),
+        ("uniq_votes_by_name", lambda: VC.extract_votes(posts),
+            lambda v: list(VC.uniq_votes_by_name(v, op=op))),
+        ("merge_votes_by_content", uniqed,
+            lambda v: list(VC.merge_votes_by_content(v))),
+        ("final_format", merged, VC.final_format),
+        ("tally_votes", lambda: posts,
+            lambda p: VC.tally_votes(p, thread['op'])),
+    ]
+
+
+def sample_stages(parser, thread, repeat, config=None):
+    """Returns an ordered list of (stage, list of repeat times in seconds) for
+    a tally of thread using parser"""
+    VC = VoteContainer()
+    VC.BBparse = parser
+    VC.settings(**(config or {}))
+
+    samples = []
+    for name, setup, run in stages(VC, thread):
+        times = []
+        for i in range(repeat):
+            arg = setup()
+            # As timeit does, keep collections out of the measurement
+            gc.disable()
+            start = time.perf_counter()
+            run(arg)
+            times.append(time.perf_counter() - start)
+            gc.enable()
+            # tally_votes resets settings from its own arguments
+            VC.settings(**(config or {}))
+        samples.append((name, times))
+
+    return samples
+
+
+def time_stages(parser, thread, repeat, config=None):
+    """Returns an ordered list of (stage, best time in seconds) for a tally of
+    thread using parser"""
+    return [(name, min(times))
+            for name, times in sample_stages(parser, thread, repeat, config)]
+
+
+def spread(times):
+    """Median absolute deviation of times, a noise estimate that a single
+    outlying run does not inflate"""
+    median = statistics.median(times)
+    return statistics.median(abs(t - median) for t in times)
+
+
+def peak_memory(parser, thread, config=None):
+    """Returns an ordered list of (stage, peak traced bytes) for a tally of
+    thread using parser"""
+    VC = VoteContainer()
+    VC.BBparse = parser
+    VC.settings(**(config or {}))
+
+    peaks = []
+    for name, setup, run in stages(VC, thread):
+        arg = setup()
+        tracemalloc.start()
+        run(arg)
+        peaks.append((name, tracemalloc.get_traced_memory()[1]))
+        tracemalloc.stop()
+        VC.settings(**(config or {}))
+
+    return peaks
+
+
+def host():
+    """Describes the host and Python that baselines are measured on"""
+    return {
+        "platform"  : platform.platform(),
+        "machine"   : platform.machine(),
+        "processor" : platform.processor(),
+        "cpus"      : os.cpu_count(),
+        "python"    : platform.python_version()
+    }
+
+
+def measure_baseline(repeat):
+    """Measures every stage of every baseline corpus with the parser that
+    voteparser uses, as the median time of repeat runs and its spread. Runs
+    go round all the corpora in turn, so that the spread covers slowdowns of
+    the host lasting longer than a stage."""
+    parser = VoteContainer().BBparse
+    threads = {name: corpus.synthetic_thread(posts, voters, seed)
+               for name, (posts, seed, voters, config) in baseline_corpora.items()}
+
+    samples = {name: {} for name in baseline_corpora}
+    reference = []
+    for i in range(repeat):
+        for name, thread in threads.items():
+            config = baseline_corpora[name][3]
+            reference.append(time_reference())
+            for stage, times in sample_stages(parser, thread, 1, config):
+                samples[name].setdefault(stage, []).extend(times)
+
+    results = {}
+    for name, thread in threads.items():
+        peaks = dict(peak_memory(parser, thread, baseline_corpora[name][3]))
+        results[name] = {
+            stage: {"time": statistics.median(times), "spread": spread(times),
+                    "peak_bytes": peaks[stage]}
+            for stage, times in samples[name].items()
+        }
+
+    return {
+        "version"   : BASELINE_VERSION,
+        "parser"    : type(parser).__module__,
+        "host"      : host(),
+        "repeat"    : repeat,
+        "reference" : {"time": statistics.median(reference),
+                       "spread": spread(reference)},
+        "corpora"   : results
+    }
+
+
+def combine(measurements):
+    """Combines a stage's measurements from several processes into the median
+    of their times, with a spread covering both the runs within a process and
+    the differences between processes"""
+    times = [i["time"] for i in measurements]
+    return {
+        "time"   : statistics.median(times),
+        "spread" : max(spread(times),
+                       statistics.median(i["spread"] for i in measurements))
+    }
+
+
+def measure_processes(repeat, processes):
+    """Runs measure_baseline in processes fresh interpreters in turn, as
+    timings shift more between processes than within one, and combines them"""
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        runs = [pool.apply(measure_baseline, (repeat,))
+                for i in range(processes)]
+
+    corpora = {}
+    for name, stages in runs[0]["corpora"].items():
+        corpora[name] = {}
+        for stage in stages:
+            measurements = [run["corpora"][name][stage] for run in runs]
+            corpora[name][stage] = dict(combine(measurements),
+                peak_bytes=statistics.median(
+                    i["peak_bytes"] for i in measurements))
+
+    return dict(runs[0], processes=processes, corpora=corpora,
+        reference=combine([run["reference"] for run in runs]))
+
+
+def host_speed(baseline, current):
+    """Returns how much slower the host ran the reference workload now than
+    for the baseline"""
+    return current["reference"]["time"] / baseline["reference"]["time"]
+
+
+def compare_baseline(baseline, current, tolerance, mem_tolerance, min_delta,
+                     noise=3):
+    """Returns a list of per stage comparisons, each flagged as a regression if
+    its time or peak memory grew by more than the tolerance. Current times are
+    first divided by host_speed. A slowdown is only flagged if it is also over
+    min_delta seconds and over noise times the larger spread of the two
+    measurements. Corpora and stages measured on only one side are listed
+    with a status of "missing" or "new"; those missing from the current
+    measurement are flagged."""
+    speed = host_speed(baseline, current)
+    rows = []
+    for name in chain(baseline["corpora"], (i for i in current["corpora"]
+                                            if i not in baseline["corpora"])):
+        before = baseline["corpora"].get(name, {})
+        after = current["corpora"].get(name, {})
+
+        for stage in chain(before, (i for i in after if i not in before)):
+            if stage not in after or stage not in before:
+                status = "missing" if stage not in after else "new"
+                rows.append({"corpus": name, "stage": stage, "status": status,
+                    "regression": status == "missing"})
+                continue
+
+            then, now = before[stage], after[stage]
+            adjusted = now["time"] / speed
+            delta = adjusted - then["time"]
+            time_ratio = adjusted / then["time"] if then["time"] else 1
+            mem_ratio = (now["peak_bytes"] / then["peak_bytes"]
+                if then["peak_bytes"] else 1)
+            slow = (time_ratio > 1 + tolerance and delta > min_delta and
+                delta > noise * max(then["spread"], now["spread"] / speed))
+            heavy = mem_ratio > 1 + mem_tolerance
+
+            rows.append({
+                "corpus"          : name,
+                "stage"           : stage,
+                "status"          : "compared",
+                "time"            : now["time"],
+                "adjusted_time"   : adjusted,
+                "spread"          : now["spread"],
+                "baseline_time"   : then["time"],
+                "baseline_spread" : then["spread"],
+                "time_ratio"      : time_ratio,
+                "peak_bytes"      : now["peak_bytes"],
+                "baseline_peak"   : then["peak_bytes"],
+                "memory_ratio"    : mem_ratio,
+                "regression"      : slow or heavy
+            })
+
+    return rows
+
+
+def print_comparison(rows, speed):
+    print("Host ran the reference workload {:.2f}x as slow as for the baseline, "
+        "time ratios allow for it".format(speed))
+    print("{:<12}{:<24}{:>11}{:>11}{:>8}{:>10}{:>8}".format(
+        "corpus", "stage", "baseline", "now", "time", "peak", "memory"))
+    for row in rows:
+        if row["status"] != "compared":
+            print("{:<12}{:<24}{} {}".format(row["corpus"], row["stage"],
+                row["status"], "from this run" if row["status"] == "missing"
+                else "since the baseline"))
+            continue
+
+        print("{:<12}{:<24}{:>9.2f}ms{:>9.2f}ms{:>7.2f}x{:>8.0f}kB{:>7.2f}x"
+            "{}".format(row["corpus"], row["stage"],
+                row["baseline_time"] * 1000, row["time"] * 1000,
+                row["time_ratio"], row["peak_bytes"] / 1024,
+                row["memory_ratio"], "  REGRESSION" if row["regression"] else ""))
+
+    regressions = sum(1 for row in rows if row["regression"])
+    print("{} of {} stages regressed or missing".format(regressions, len(rows)))
+
+
+def calibrate(repeat, headroom=1.5):
+    """Measures whole tallies with the parser voteparser uses, returns cost
+    coefficients for main's limits: seconds per post from many small posts,
+    and seconds per character from posts dense with vote lines, both with
+    headroom"""
+    VC = VoteContainer()
+
+    def best(thread):
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            VC.tally_votes(thread['posts'], thread['op'])
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    small = corpus.synthetic_thread(4000)
+    dense = corpus.dense_thread(20)
+    chars = sum(len(post['message']) for post in dense['posts'])
+
+    return {
+        "cost_per_post" : headroom * best(small) / len(small['posts']),
+        "cost_per_byte" : headroom * best(dense) / chars
+    }
+
+
+def run_baseline(args):
+    """Handles --save-baseline and --compare, returns the exit status"""
+    current = measure_processes(args.repeat, args.processes)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        if args.json:
+            print(json.dumps(current, indent=2, sort_keys=True))
+        else:
+            print("Saved baseline for {} corpora to {}".format(
+                len(current["corpora"]), args.baseline))
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print("No baseline at {}, save one on this host with "
+            "--save-baseline".format(args.baseline), file=sys.stderr)
+        return 2
+
+    if baseline.get("version") != BASELINE_VERSION:
+        print("Baseline version {} does not match {}, save a new one".format(
+            baseline.get("version"), BASELINE_VERSION), file=sys.stderr)
+        return 2
+    if baseline.get("parser") != current["parser"]:
+        print("Warning: baseline was measured with {}, now using {}".format(
+            baseline.get("parser"), current["parser"]), file=sys.stderr)
+    for key, value in current["host"].items():
+        if baseline.get("host", {}).get(key) != value:
+            print("Warning: baseline was measured with {} {}, now {}".format(
+                key, baseline.get("host", {}).get(key), value), file=sys.stderr)
+
+    rows = compare_baseline(baseline, current, args.tolerance,
+        args.memory_tolerance, args.min_delta / 1000, args.noise)
+    speed = host_speed(baseline, current)
+    if args.json:
+        print(json.dumps({"parser": current["parser"], "host_speed": speed,
+            "stages": rows}, indent=2))
+    else:
+        print_comparison(rows, speed)
+
+    return 1 if any(row["regression"] for row in rows) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--processes', type=int, default=MIN_PROCESSES,
+        help="processes to measure baselines in")
+    parser.add_argument('--baseline', default='bench_baseline.json',
+        help="baseline file for --save-baseline and --compare")
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true',
+        help="compare against the baseline, exit 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help="allowed fractional slowdown per stage")
+    parser.add_argument('--memory-tolerance', type=float, default=0.1,
+        help="allowed fractional growth in peak memory per stage")
+    parser.add_argument('--min-delta', type=float, default=1.0,
+        help="ignore slowdowns of less than this many milliseconds")
+    parser.add_argument('--noise', type=float, default=3,
+        help="ignore slowdowns of less than this many times the spread of "
+        "the runs")
+    parser.add_argument('--json', action='store_true',
+        help="print results as JSON")
+    parser.add_argument('--calibrate', action='store_true',
+        help="print cost coefficients for main's limits")
+    args = parser.parse_args(argv)
+
+    if args.calibrate:
+        print(json.dumps({"limits": calibrate(args.repeat)}, indent=2))
+        return
+
+    if args.save_baseline or args.compare:
+        if args.repeat < MIN_REPEAT or args.processes < MIN_PROCESSES:
+            parser.error("--save-baseline and --compare need --repeat {} and "
+                "--processes {} or more".format(MIN_REPEAT, MIN_PROCESSES))
+        sys.exit(run_baseline(args))
+
+    thread = corpus.synthetic_thread(args.posts, seed=args.seed)
+    py = time_stages(bbcodeparser.BBCodeParser(), thread, args.repeat)
+
+    if _bbcodeparser is None:
+        print("_bbcodeparser is not built, timing pure Python only")
+        for name, t in py:
+            print("{:<24}{:>10.2f}ms".format(name, t * 1000))
+        return
+
+    c = time_stages(_bbcodeparser.BBCodeParser(), thread, args.repeat)
+    print("{:<24}{:>12}{:>12}{:>9}".format(
+        "stage", "python", "compiled", "speedup"))
+    for (name, tp), (_, tc) in zip(py, c):
+        print("{:<24}{:>10.2f}ms{:>10.2f}ms{:>8.2f}x".format(
+            name, tp * 1000, tc * 1000, tp / tc))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import random
+
+# Building blocks for synthetic posts. Votes are drawn from a small pool of
+# plans so that merging has something to do.
+plan_lines = [
+    "Go to the market", "Talk to [b]Ugo[/b]", "Train with the sword",
+    "Investigate the [i]ruins[/i]", "Write home", "Rest", "Scout the pass",
+    "Apply hugs to Ugo", "[color=red]Burn it all[/color]", "Study magic"
+]
+
+filler = [
+    "I think this is the best option we have.",
+    "[b]Strongly[/b] disagree with the plan above, because reasons.",
+    "Has anyone considered what happens if the [i]ruins[/i] are trapped?",
+    "Just voting for now, will write more later.",
+    "[url=http://example.com]Relevant link[/url] for the discussion.",
+    "Lots of dissertation about tactics and character motivation."
+]
+
+
+def synthetic_vote(rng):
+    """Returns a list of vote lines, with indented subvotes"""
+    lines = []
+    for plan in rng.sample(plan_lines, rng.randint(1, 3)):
+        lines.append("[X] {}".format(plan))
+        for i in range(rng.randint(0, 2)):
+            lines.append("-[X] {}".format(rng.choice(plan_lines)))
+    return lines
+
+
+def synthetic_post(rng, n, voters, previous):
+    """Returns a single post dictionary in the format accepted by main"""
+    username = rng.choice(voters)
+    body = [rng.choice(filler) for i in range(rng.randint(0, 3))]
+
+    roll = rng.random()
+    if previous and roll < 0.2:
+        # Quote an earlier post, votes and all
+        quoted = rng.choice(previous)
+        body.insert(0, '[QUOTE="{}, post: {}, member: 1"]{}[/QUOTE]'.format(
+            quoted['username'], quoted['post_id'], quoted['message']))
+    if roll < 0.1:
+        body.append("[spoiler]\n[X] {}[/spoiler]".format(
+            rng.choice(plan_lines)))
+
+    if roll > 0.85:
+        # Vote by referral to another voter's plan
+        body.append("[X] {}".format(rng.choice(voters)))
+    elif roll > 0.3:
+        body.extend(synthetic_vote(rng))
+
+    return {
+        'username' : username,
+        'user_id'  : 1000 + voters.index(username),
+        'post_id'  : n,
+        'message'  : "\n".join(body) + "\n"
+    }
+
+
+def synthetic_thread(n_posts=500, n_voters=None, seed=0):
+    """Returns a deterministic thread of n_posts posts, as accepted by main"""
+    rng = random.Random(seed)
+    voters = ["Voter{}".format(i) for i in range(n_voters or n_posts // 3 + 1)]
+
+    posts = []
+    for n in range(1, n_posts + 1):
+        posts.append(synthetic_post(rng, n, voters, posts[-20:]))
+
+    return {'op': 'Firnagzen', 'posts': posts}
+
+
+def dense_thread(n_posts=20, chars=100000):
+    """Returns a thread of n_posts posts of about chars characters, made
+    entirely of formatted vote lines, the worst case per character"""
+    line = "-[X] [b]Vote line[/b] with [i]some[/i] [color=red]markup[/color]\n"
+    message = line * (chars // len(line))
+
+    posts = [
+        {'username': "Voter{}".format(n), 'user_id': 1000 + n, 'post_id': n,
+         'message': message}
+        for n in range(1, n_posts + 1)
+    ]
+    return {'op': 'Firnagzen', 'posts': posts}
@@ -0,0 +1,146 @@
+"""Checks that the compiled parser in _bbcodeparser produces output identical
+to the pure Python bbcodeparser, stage by stage and for whole tallies. Exits
+non-zero on the first mismatch, or if the compiled parser is not built.
+
+python differential.py
+"""
+import sys
+from textwrap import dedent
+
+import corpus
+import bbcodeparser
+from voteparser import VoteContainer
+
+# Inputs that have tripped up the tokenizer: nested and unbalanced brackets,
+# quoted attributes, excluded tags in odd places.
+edge_cases = [
+    "",
+    "\n",
+    "[X] plain\n",
+    "[x] no trailing newline",
+    "[[X]] double bracket\n",
+    "[X] [b]open bold\n[X] still bold[/b]\n",
+    "[b][X] bold[/b] [i]italic\n",
+    "[/b][X] stray close\n",
+    "[color=red][X] red[/color]\n",
+    "[color='red'][X] quoted attribute[/color]\n",
+    "[font=\"Tahoma\"][X] double quoted[/font]\n",
+    "[url=http://a.b/[x]][X] bracket in attribute[/url]\n",
+    "[QUOTE=\"A, post: 1, member: 100\"]\n[X] quoted\n[/QUOTE]\n[X] real\n",
+    "[quote][quote][X] nested[/quote]\n[X] still quoted\n[/quote]\n[X] out\n",
+    "[spoiler]\n[X] hidden[/spoiler][X] after\n",
+    "[s][X] struck[/s]\n[X] kept\n",
+    "[quote][X] never closed\n[X] rest\n",
+    "[/quote]\n[X] stray excluded close\n",
+    "[X][b]subvote[/b]\n-[X] dash\n---[X] deep\n",
+    "[X] [unknown]tag[/unknown]\n",
+    "[=x][X] empty name\n",
+    "[X] a=b] c[d\n",
+    dedent("""\
+        [font=\"Tahoma\"][i]absbdasd[color=green]
+        [x] vote1
+        -- [b][x] vote[/color]
+        [b]test1
+        [i]test2[/i][/b]kjahsd[color='red']kash[/color][x] vot
+
+        [QUOTE="'Lement, post: 4046370, member: 4959"][X] this is a vote
+        --[b][x] subvote[/b][/font]
+        - [color=red][x] another subvote[/color]
+        [QUOTE]state.[/QUOTE][/QUOTE]kasjdh[list][/b]aoishdu912
+        [x] stooopid
+        """),
+]
+
+configs = [
+    {},
+    {"break_level": 1},
+    {"break_level": 2},
+    {"refer_dir": 1, "sort_highest": 1},
+    {"sort_highest": 1, "limit": 5, "offset": 2},
+    {"structured": 1},
+]
+
+
+def threads():
+    yield corpus.synthetic_thread(300, seed=1)
+    yield corpus.synthetic_thread(1000, n_voters=50, seed=2)
+    yield {
+        'op': 'Firnagzen',
+        'posts': [
+            {'username': 'U{}'.format(n % 7), 'user_id': n, 'post_id': n,
+             'message': message}
+            for n, message in enumerate(edge_cases)
+        ]
+    }
+
+
+def compare(stage, item, py, c):
+    if py != c:
+        print("Mismatch in {} for {!r}".format(stage, item))
+        print("  python  : {!r}".format(py))
+        print("  compiled: {!r}".format(c))
+        sys.exit(1)
+
+
+def main():
+    try:
+        import _bbcodeparser
+    except ImportError:
+        print("_bbcodeparser is not built, run "
+            "'python setup.py build_ext --inplace'")
+        sys.exit(2)
+
+    py_vc, c_vc = VoteContainer(), VoteContainer()
+    py_vc.BBparse = bbcodeparser.BBCodeParser()
+    c_vc.BBparse = _bbcodeparser.BBCodeParser()
+    py_vc.settings()
+    c_vc.settings()
+    py_bb, c_bb = py_vc.BBparse, c_vc.BBparse
+
+    messages = list(edge_cases)
+    for thread in threads():
+        messages.extend(post['message'] for post in thread['posts'])
+
+    for message in messages:
+        for exclude in ((), py_vc.rem_text):
+            # Each parser only recognises its own Tag type
+            py_tags = py_bb.parse_tags(message, exclude)
+            c_tags = c_bb.parse_tags(message, exclude)
+            compare("parse_tags", message, repr(py_tags), repr(c_tags))
+
+            compare("index_tag_pairs", message,
+                py_bb.index_tag_pairs(py_tags, py_vc.rem_text),
+                c_bb.index_tag_pairs(c_tags, py_vc.rem_text))
+
+            for max_lines in (0, 1):
+                compare("line_extract", message,
+                    repr(py_bb.line_extract(py_tags, py_vc.is_vote,
+                        max_lines=max_lines)),
+                    repr(c_bb.line_extract(c_tags, py_vc.is_vote,
+                        max_lines=max_lines)))
+
+        # The older exclusion path, tokens kept and their ranges skipped
+        py_tags = py_bb.parse_tags(message)
+        c_tags = c_bb.parse_tags(message)
+        ranges = py_bb.index_tag_pairs(py_tags, py_vc.rem_text)
+        for max_lines in (0, 1):
+            compare("line_extract with ignore_ranges", message,
+                repr(py_bb.line_extract(py_tags, py_vc.is_vote, ranges,
+                    max_lines)),
+                repr(c_bb.line_extract(c_tags, py_vc.is_vote, ranges,
+                    max_lines)))
+
+    tallies = 0
+    for thread in threads():
+        for config in configs:
+            compare("tally_votes", config,
+                py_vc.tally_votes(thread['posts'], thread['op'], **config),
+                c_vc.tally_votes(thread['posts'], thread['op'], **config))
+            tallies += 1
+
+    print("{} messages and {} tallies identical".format(len(messages),
+        tallies))
+
+
+if __name__ == '__main__':
+    main()
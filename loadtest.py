@@ -0,0 +1,302 @@
+"""Load generator for the /tally service. Starts main:api under gunicorn,
+replays synthetic or recorded thread payloads against it from concurrent
+clients and reports throughput, latency percentiles, timeout rate and the
+RSS of each gunicorn worker.
+
+The tally timeout relies on SIGALRM and settings shared by a worker's
+VoteContainer, so only the sync worker class, which handles one request at a
+time on the main thread, is supported. Other worker classes are refused.
+
+python loadtest.py --workers 4 --worker-class sync --concurrency 8
+python loadtest.py --payload pmas.json --requests 200
+"""
+import os, sys, json, time, signal, argparse, threading, subprocess
+import http.client
+from collections import deque
+
+import corpus
+
+# Worker classes that run each request alone on the main thread
+sync_workers = ('sync', 'gunicorn.workers.sync.SyncWorker')
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list, 0 if empty"""
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def child_pids(ppid):
+    """Lists pids whose parent is ppid, read from /proc"""
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # The process name may contain spaces, so split after it
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if int(fields[1]) == ppid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_kb(pid):
+    """Resident set size of pid in kB, or 0 if it has gone away"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+class Server(object):
+    """Runs main:api under gunicorn for the duration of a with block"""
+    def __init__(self, host, port, workers, worker_class, timeout):
+        self.host, self.port = host, port
+        self.cmd = [
+            sys.executable, '-m', 'gunicorn',
+            '--bind', '{}:{}'.format(host, port),
+            '--workers', str(workers),
+            '--worker-class', worker_class,
+            '--timeout', str(timeout),
+            '--log-level', 'warning',
+            'main:api'
+        ]
+        self.proc = None
+
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError("gunicorn exited with {}".format(
+                    self.proc.returncode))
+            try:
+                conn = http.client.HTTPConnection(self.host, self.port, 1)
+                conn.request('GET', '/tally')
+                if conn.getresponse().status == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.1)
+        raise RuntimeError("gunicorn did not come up in {}s".format(timeout))
+
+
+    def workers(self):
+        return child_pids(self.proc.pid)
+
+
+    def __enter__(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.proc = subprocess.Popen(self.cmd, cwd=here)
+        try:
+            self.wait_ready()
+        except Exception:
+            self.__exit__()
+            raise
+        return self
+
+
+    def __exit__(self, *exc):
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+class LoadTest(object):
+    def __init__(self, server, payloads, concurrency, requests, duration,
+                 client_timeout):
+        self.server = server
+        self.payloads = payloads
+        self.concurrency = concurrency
+        self.requests = requests
+        self.duration = duration
+        self.client_timeout = client_timeout
+
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.results = deque() # (latency, status, timed_out)
+        self.peak_rss = dict()
+
+
+    def next_payload(self):
+        """Returns the next payload to send, or None once the run is over"""
+        with self.lock:
+            if self.requests and self.sent >= self.requests:
+                return None
+            if self.duration and time.time() > self.deadline:
+                return None
+            payload = self.payloads[self.sent % len(self.payloads)]
+            self.sent += 1
+            return payload
+
+
+    def client(self):
+        conn = None
+        headers = {'Content-Type': 'application/json'}
+
+        while True:
+            payload = self.next_payload()
+            if payload is None:
+                break
+
+            if conn is None:
+                conn = http.client.HTTPConnection(
+                    self.server.host, self.server.port, self.client_timeout)
+
+            start = time.perf_counter()
+            try:
+                conn.request('POST', '/tally', payload, headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                status = resp.status
+                timed_out = status == 400 and b'timed out' in body
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = None
+                status, timed_out = None, True
+
+            self.results.append((time.perf_counter() - start, status,
+                timed_out))
+
+        if conn is not None:
+            conn.close()
+
+
+    def sample_rss(self, stop):
+        while not stop.wait(0.2):
+            for pid in self.server.workers():
+                self.peak_rss[pid] = max(self.peak_rss.get(pid, 0),
+                    rss_kb(pid))
+
+
+    def run(self):
+        self.deadline = time.time() + (self.duration or 0)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self.sample_rss, args=(stop,))
+        sampler.start()
+
+        clients = [threading.Thread(target=self.client)
+            for i in range(self.concurrency)]
+        start = time.perf_counter()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        self.elapsed = time.perf_counter() - start
+
+        stop.set()
+        sampler.join()
+
+
+    def report(self):
+        latencies = sorted(l for l, status, t in self.results if status == 202)
+        total = len(self.results)
+        timeouts = sum(1 for l, s, t in self.results if t)
+        errors = sum(1 for l, s, t in self.results if s != 202 and not t)
+
+        return {
+            "requests"     : total,
+            "elapsed_s"    : self.elapsed,
+            "throughput"   : total / self.elapsed if self.elapsed else 0,
+            "p50_ms"       : percentile(latencies, 50) * 1000,
+            "p95_ms"       : percentile(latencies, 95) * 1000,
+            "p99_ms"       : percentile(latencies, 99) * 1000,
+            "timeout_rate" : timeouts / total if total else 0,
+            "errors"       : errors,
+            "worker_rss_kb": self.peak_rss
+        }
+
+
+def load_payloads(args):
+    """Encodes the payloads to replay, recorded files if given, otherwise a
+    synthetic thread"""
+    config = json.loads(args.config) if args.config else None
+    threads = []
+    if args.payload:
+        for path in args.payload:
+            with open(path) as f:
+                threads.append(json.load(f))
+    else:
+        for seed in range(args.threads):
+            threads.append(corpus.synthetic_thread(args.posts, seed=seed))
+
+    payloads = []
+    for thread in threads:
+        if config is not None:
+            thread['config'] = config
+        thread.setdefault('op', 'Firnagzen')
+        payloads.append(json.dumps(thread).encode())
+    return payloads
+
+
+def print_report(report, args):
+    print("workers={} worker_class={} concurrency={}".format(
+        args.workers, args.worker_class, args.concurrency))
+    print("requests      : {requests} in {elapsed_s:.2f}s".format(**report))
+    print("throughput    : {throughput:.1f} req/s".format(**report))
+    print("latency       : p50 {p50_ms:.1f}ms, p95 {p95_ms:.1f}ms, "
+        "p99 {p99_ms:.1f}ms".format(**report))
+    print("timeout rate  : {:.2%}".format(report['timeout_rate']))
+    print("other errors  : {errors}".format(**report))
+    for pid, rss in sorted(report['worker_rss_kb'].items()):
+        print("worker {:>7} : {:.1f} MiB peak RSS".format(pid, rss / 1024))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100,
+        help="number of requests to send, 0 to run for --duration")
+    parser.add_argument('--duration', type=float, default=0,
+        help="seconds to run for when --requests is 0")
+    parser.add_argument('--payload', action='append',
+        help="recorded thread JSON to replay, may be repeated")
+    parser.add_argument('--posts', type=int, default=500,
+        help="posts per synthetic thread")
+    parser.add_argument('--threads', type=int, default=4,
+        help="number of distinct synthetic threads")
+    parser.add_argument('--config', help="tally config JSON sent with each "
+        "request, eg. '{\"break_level\": 1}'")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--server-timeout', type=int, default=30,
+        help="gunicorn worker timeout")
+    parser.add_argument('--client-timeout', type=float, default=30)
+    parser.add_argument('--json', action='store_true',
+        help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if not args.requests and not args.duration:
+        parser.error("one of --requests or --duration is required")
+    if args.worker_class not in sync_workers:
+        parser.error("--worker-class {} is not supported, the tally timeout "
+            "needs sync workers".format(args.worker_class))
+
+    payloads = load_payloads(args)
+
+    with Server(args.host, args.port, args.workers, args.worker_class,
+                args.server_timeout) as server:
+        test = LoadTest(server, payloads, args.concurrency, args.requests,
+            args.duration, args.client_timeout)
+        test.run()
+
+    report = test.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,177 @@
-import json, falcon
-import voteparser
+import os, hmac, zlib, json, base64, hashlib, falcon
+import voteparser, sharedcache, profiling
  
 class TallyApp(object):
     def __init__(self):
         self.VC = voteparser.VoteContainer()
 
+        self.limits = {
+            "max_body_bytes"     : 16 * 1024 * 1024,
+            "max_posts"          : 10000,
+            "max_message_length" : 100000,
+            # Posts with more vote lines are rejected, but only once the whole
+            # message is tokenized, which max_message_length bounds
+            "max_vote_lines"     : 500,
+            # Seconds per post and per message character. Worst cases from
+            # 'python bench.py --calibrate' with the pure Python parser, where
+            # posts dense with vote lines cost ~7e-7s per character, with
+            # headroom for slower hosts. Recalibrate for the deployment.
+            "cost_per_post"      : 0.0001,
+            "cost_per_byte"      : 0.000001,
+            # Decompressed size of a /tally/diff token
+            "max_state_bytes"    : 64 * 1024 * 1024
+        }
 
-    def load_config(self):
-        pass
-        # Use dict update to udate dict from config?
+        self.chunk_size = 64 * 1024
+
+        # Set from the "profiling" config section, None when disabled
+        self.profiler = None
+
+        # Signs /tally/diff tokens, from the "diff" config section
+        self.diff_secret = b""
+
+        self.load_config()
+
+
+    def load_config(self, path=None):
+        """Updates settings from a JSON config file, by default the one named
+        by the VOTETALLY_CONFIG environment variable, of the format
+        {"timeout": <int>, "limits": {...},
+         "cache": {"max_bytes": <int, 0 to disable>} or
+                  {"socket": <str>, "authkey" or "authkey_file": <str>},
+         "diff": {"secret" or "secret_file": <str>},
+         "profiling": {"directory": <str>, "max_artifacts": <int>,
+                       "sample_rate": <float 0-1>, "header": <str>}}"""
+        path = path or os.environ.get("VOTETALLY_CONFIG")
+        config = dict()
+        if path:
+            with open(path) as f:
+                config = json.load(f)
+
+        self.limits.update(config.get("limits", {}))
+        self.VC.timeout = config.get("timeout", self.VC.timeout)
+        self.VC.max_vote_lines = self.limits["max_vote_lines"]
+
+        # Share a sidecar's cache between workers if given its socket,
+        # otherwise keep a cache per worker
+        cache = config.get("cache", {})
+        if cache.get("socket"):
+            authkey = self.secret(cache, "authkey")
+            if not authkey:
+                raise ValueError("cache.socket needs an authkey or "
+                    "authkey_file, the same one the sidecar uses")
+            self.VC.cache = sharedcache.SharedCache(cache["socket"], authkey)
+        elif cache.get("max_bytes", 1) > 0:
+            self.VC.cache = sharedcache.LocalCache(
+                cache.get("max_bytes", 32 * 1024 * 1024))
+
+        if config.get("profiling", {}).get("directory"):
+            self.profiler = profiling.RequestProfiler(**config["profiling"])
+
+        self.diff_secret = self.secret(config.get("diff", {}), "secret")
+
+
+    def secret(self, section, name):
+        """Returns the secret given as name, or read from the file given as
+        name_file, in a config section. Empty if neither is given."""
+        if section.get(name + "_file"):
+            with open(section[name + "_file"], 'rb') as f:
+                return f.read().strip()
+        return section.get(name, "").encode()
+
+
+    def too_large(self, description):
+        return falcon.HTTPError(falcon.HTTP_413,
+            'Request too large',
+            description)
+
+
+    def read_body(self, req):
+        """Reads the request body in chunks, rejecting it as soon as it goes
+        over max_body_bytes"""
+        max_bytes = self.limits["max_body_bytes"]
+        if req.content_length and req.content_length > max_bytes:
+            raise self.too_large(
+                'Request body exceeds {} bytes.'.format(max_bytes))
+
+        body = bytearray()
+        while True:
+            chunk = req.bounded_stream.read(self.chunk_size)
+            if not chunk:
+                break
+
+            body += chunk
+            if len(body) > max_bytes:
+                raise self.too_large(
+                    'Request body exceeds {} bytes.'.format(max_bytes))
+
+        return body.decode()
+
+
+    def check_config(self, config):
+        """Rejects configs with anything but tally settings, so that requests
+        cannot change the server's limits or timeout, and pages that are not
+        non-negative integers"""
+        if not isinstance(config, dict):
+            raise falcon.HTTPError(falcon.HTTP_400,
+                'Invalid config',
+                'The config must be an object.')
+
+        unknown = set(config) - set(self.VC.defaults)
+        if unknown:
+            raise falcon.HTTPError(falcon.HTTP_400,
+                'Invalid config',
+                'Unknown settings: {}.'.format(', '.join(sorted(unknown))))
+
+        for key in ('limit', 'offset'):
+            value = config.get(key, 0)
+            if type(value) is not int or value < 0:
+                raise falcon.HTTPError(falcon.HTTP_400,
+                    'Invalid config',
+                    '{} must be a non-negative integer.'.format(key))
+
+
+    def check_posts(self, posts):
+        """Rejects post lists that go over the post limits, or whose estimated
+        tally time would not fit in the timeout"""
+        if len(posts) > self.limits["max_posts"]:
+            raise self.too_large(
+                'More than {} posts.'.format(self.limits["max_posts"]))
+
+        size = 0
+        for post in posts:
+            length = len(post['message'])
+            if length > self.limits["max_message_length"]:
+                raise self.too_large(
+                    'Post {} is longer than {} characters.'.format(
+                        post['post_id'], self.limits["max_message_length"]))
+            size += length
+
+        cost = (len(posts) * self.limits["cost_per_post"] +
+                size * self.limits["cost_per_byte"])
+        if cost > self.VC.timeout:
+            raise self.too_large(
+                'Estimated tally time of {:.1f}s exceeds the {}s limit.'.format(
+                    cost, self.VC.timeout))
+
+
+    def stream_json_string(self, chunks):
+        """Generator, encodes an iterable of string chunks as a single JSON
+        string, yielding bytes as each chunk is ready"""
+        yield b'"'
+        for chunk in chunks:
+            yield json.dumps(chunk)[1:-1].encode()
+        yield b'"'
+
+
+    def stream_json_list(self, items):
+        """Generator, encodes an iterable of objects as a JSON list, yielding
+        bytes as each item is ready"""
+        sep = b'['
+        for item in items:
+            yield sep + json.dumps(item).encode()
+            sep = b', '
+        yield b']' if sep == b', ' else b'[]'
 
 
     def on_get(self, req, resp):
@@ -17,42 +180,142 @@ class TallyApp(object):
         resp.body = 'Vote tally active'
  
 
-    def on_post(self, req, resp):
-        """Handles POST requests"""
+    def read_request(self, req):
+        """Reads and checks a tally request, returns the decoded JSON"""
         try:
-            raw_json = req.stream.read().decode()
+            raw_json = self.read_body(req)
+        except falcon.HTTPError:
+            raise
         except Exception as ex:
             raise falcon.HTTPError(falcon.HTTP_400,
                 'Error',
-                ex.message)
+                str(ex))
  
         try:
-            result_json = json.loads(raw_json, encoding='utf-8')
+            result_json = json.loads(raw_json)
         except ValueError:
             raise falcon.HTTPError(falcon.HTTP_400,
                 'Malformed JSON',
                 'Could not decode the request body. The '
                 'JSON was incorrect.')
 
-        args = result_json['config'] if 'config' in result_json else dict()
+        result_json.setdefault('config', dict())
+        self.check_config(result_json['config'])
+        self.check_posts(result_json['posts'])
+
+        return result_json
+
+
+    def on_post(self, req, resp):
+        """Handles POST requests"""
+        result_json = self.read_request(req)
+
+        args = result_json['config']
         posts = result_json['posts']
         op = result_json['op']
 
+        mode = self.profiler.mode(req) if self.profiler is not None else None
+
         try:
-            result = self.VC.tally_votes_timeout(posts, op, **args)
+            if mode:
+                # Format inside the capture rather than while streaming
+                result = self.profiler.capture(mode, posts, args, lambda: list(
+                    self.VC.tally_votes_iter_timeout(posts, op, **args)))
+            else:
+                result = self.VC.tally_votes_iter_timeout(posts, op, **args)
+        except voteparser.LimitError as ex:
+            raise self.too_large(str(ex))
         except voteparser.TimeoutError:
             raise falcon.HTTPError(falcon.HTTP_400, "Operation timed out.")
         else:
             resp.status = falcon.HTTP_202
-            resp.body = json.dumps(result)
+            if args.get('structured'):
+                resp.stream = self.stream_json_list(result)
+            else:
+                resp.stream = self.stream_json_string(result)
  
 
+class TallyDiff(object):
+    """Reports the changes to a tally since an earlier one. The state of the
+    earlier tally is carried by the token returned with it, compressed and
+    signed with the diff secret, so any worker can diff against it. Without a
+    configured secret tokens are only checked for corruption, and a client can
+    alter the state its own diff is made against."""
+    def __init__(self, app):
+        self.app = app
+        self.VC = app.VC
+
+
+    def sign(self, payload):
+        return hmac.new(self.app.diff_secret, payload, hashlib.sha256).digest()
+
+
+    def dump_token(self, state):
+        payload = zlib.compress(json.dumps(state, separators=(',', ':')).encode())
+        return base64.urlsafe_b64encode(self.sign(payload) + payload).decode()
+
+
+    def load_token(self, token):
+        """Returns the state in token, raising ValueError if it was not signed
+        with the diff secret, decompresses past max_state_bytes, or is not
+        structured as a state"""
+        data = base64.urlsafe_b64decode(token.encode())
+        signature, payload = data[:32], data[32:]
+        if not hmac.compare_digest(signature, self.sign(payload)):
+            raise ValueError("Bad signature")
+
+        decompressor = zlib.decompressobj()
+        raw = decompressor.decompress(payload, self.app.limits["max_state_bytes"])
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("State too large")
+
+        state = json.loads(raw.decode())
+        self.VC.check_state(state)
+        return state
+
+
+    def on_post(self, req, resp):
+        """Handles POST requests"""
+        result_json = self.app.read_request(req)
+
+        state = None
+        if result_json.get('token'):
+            try:
+                state = self.load_token(result_json['token'])
+            except (ValueError, TypeError, AttributeError):
+                raise falcon.HTTPError(falcon.HTTP_400,
+                    'Invalid token',
+                    'The token was not returned by an earlier diff.')
+
+        try:
+            result, state = self.VC.run_timeout(self.VC.diff_tally,
+                result_json['posts'], result_json['op'], state,
+                **result_json['config'])
+        except voteparser.StateError as ex:
+            raise falcon.HTTPError(falcon.HTTP_409, 'Settings changed', str(ex))
+        except voteparser.LimitError as ex:
+            raise self.app.too_large(str(ex))
+        except voteparser.TimeoutError:
+            raise falcon.HTTPError(falcon.HTTP_400, "Operation timed out.")
+
+        result['token'] = self.dump_token(state)
+
+        resp.status = falcon.HTTP_202
+        resp.body = json.dumps(result)
+
+
 wsgi_app = api = falcon.API()
 app = TallyApp()
 api.add_route('/tally', app)
+api.add_route('/tally/diff', TallyDiff(app))
 
 # source venv/bin/activate
-# gunicorn main:api
+# VOTETALLY_CONFIG=config.json gunicorn main:api
+# To share a cache between workers, first run
+# python sharedcache.py --socket $XDG_RUNTIME_DIR/votetally-cache.sock \
+#     --authkey-file cache.key
+# with {"cache": {"socket": <that path>, "authkey_file": "cache.key"}} in
+# config.json
 # http://localhost:8000/tally
 
 
@@ -75,6 +338,43 @@ api.add_route('/tally', app)
 #                    "refer_dir"          : <int 0-1>,
 #                    "vote_marker"        : <str "\[[Xx]\]">,
 #                    "instant_runoff"     : <int 0-1>,
-#                    "sort_highest"       : <int 0-1>
+#                    "sort_highest"       : <int 0-1>,
+#                    "limit"              : <int, 0 for all>,
+#                    "offset"             : <int>,
+#                    "structured"         : <int 0-1>
 #                }
+# }
+# Any other config key is rejected with a 400; the timeout and limits are only
+# set by the server's config file.
+
+# With "structured" set, the response is a list of votes instead of a string:
+# [
+#      {
+#          'vote'       : <str, reconstructed BBCode>,
+#          'lines'      : [<str>, ...],
+#          'count'      : <int>,
+#          'voters_full': [[<username>, <post_id>], ...]
+#      },
+#      ...
+# ]
+
+# /tally/diff takes the same request plus the 'token' returned by the previous
+# call, if any, and responds with the changes since then. The token must come
+# from a call with the same op, break_level, refer_dir, vote_marker and
+# instant_runoff, or the response is a 409. Set a "diff" secret in the config
+# of every worker so tokens cannot be forged.
+# {
+#      'token'  : <str, pass to the next call>,
+#      'new'    : [{'vote': <str>, 'count': <int>}, ...],
+#      'removed': [{'vote': <str>, 'count': <int>}, ...],
+#      'counts' : [{'vote': <str>, 'old': <int>, 'new': <int>}, ...],
+#      'moved'  : [
+#                     {
+#                         'voter'  : <str>,
+#                         'post_id': <int or null if the voter left>,
+#                         'from'   : [<str>, ...],
+#                         'to'     : [<str>, ...]
+#                     },
+#                     ...
+#                 ]
 # }
\ No newline at end of file
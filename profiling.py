@@ -0,0 +1,123 @@
+"""Opt-in profiling of single tally requests. A request is profiled when it
+carries the trigger header, or at random at the sample rate. The cProfile
+stats or tracemalloc snapshot of the tally are written to a directory along
+with the shape of the payload, never its text, keeping only the newest
+max_artifacts captures.
+
+Load a capture with pstats.Stats(path) or tracemalloc.Snapshot.load(path).
+"""
+import os, json, time, random, cProfile, threading, tracemalloc
+
+
+class RequestProfiler(object):
+    def __init__(self, directory, max_artifacts=20, sample_rate=0.0,
+                 header='X-Tally-Profile'):
+        self.directory = directory
+        self.max_artifacts = max_artifacts
+        self.sample_rate = sample_rate
+        self.header = header
+
+        # Only one profiler can run at a time in a process
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+
+    def mode(self, req):
+        """Returns 'cprofile' or 'tracemalloc' if req should be profiled,
+        otherwise None"""
+        if self.header:
+            requested = req.get_header(self.header)
+            if requested:
+                return ('tracemalloc' if requested.lower() == 'tracemalloc'
+                    else 'cprofile')
+
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'cprofile'
+
+        return None
+
+
+    def payload_shape(self, posts, config):
+        """Describes posts by size and markup density, without their text"""
+        sizes = [len(post['message']) for post in posts]
+        total = sum(sizes)
+        tags = sum(post['message'].count('[') for post in posts)
+        lines = sum(post['message'].count('\n') for post in posts)
+
+        return {
+            "posts"          : len(posts),
+            "voters"         : len(set(post['username'] for post in posts)),
+            "total_chars"    : total,
+            "min_chars"      : min(sizes) if sizes else 0,
+            "max_chars"      : max(sizes) if sizes else 0,
+            "mean_chars"     : total / len(sizes) if sizes else 0,
+            "lines"          : lines,
+            "tags_per_kchar" : 1000 * tags / total if total else 0,
+            "config"         : config
+        }
+
+
+    def capture(self, mode, posts, config, func):
+        """Runs func under the profiler given by mode and saves the capture,
+        even if func raises. Runs func unprofiled if another capture is in
+        progress."""
+        if not self.lock.acquire(False):
+            return func()
+
+        start = time.perf_counter()
+        try:
+            if mode == 'tracemalloc':
+                tracemalloc.start(25)
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+            try:
+                result = func()
+                status = "ok"
+            except BaseException as ex:
+                status = type(ex).__name__
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                if mode == 'tracemalloc':
+                    snapshot = tracemalloc.take_snapshot()
+                    tracemalloc.stop()
+                else:
+                    profiler.disable()
+
+            return result
+
+        finally:
+            try:
+                # Names sort oldest first for prune
+                name = os.path.join(self.directory, "{:020d}-{}".format(
+                    time.time_ns(), os.getpid()))
+                if mode == 'tracemalloc':
+                    snapshot.dump(name + '.tracemalloc')
+                else:
+                    profiler.dump_stats(name + '.prof')
+
+                shape = self.payload_shape(posts, config)
+                shape.update(mode=mode, status=status, seconds=elapsed)
+                with open(name + '.json', 'w') as f:
+                    json.dump(shape, f, indent=2)
+
+                self.prune()
+            finally:
+                self.lock.release()
+
+
+    def prune(self):
+        """Deletes all but the newest max_artifacts captures"""
+        captures = sorted(set(
+            os.path.splitext(i)[0] for i in os.listdir(self.directory)
+            if i.endswith('.json')
+        ))
+        for capture in captures[:-self.max_artifacts or None]:
+            for ext in ('.json', '.prof', '.tracemalloc'):
+                try:
+                    os.remove(os.path.join(self.directory, capture + ext))
+                except OSError:
+                    pass
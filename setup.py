@@ -0,0 +1,10 @@
+# Builds the optional compiled parser in place:
+#     python setup.py build_ext --inplace
+# voteparser falls back to the pure Python parser when it is not built.
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name="votetally",
+    ext_modules=cythonize("_bbcodeparser.pyx")
+)
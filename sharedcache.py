@@ -0,0 +1,230 @@
+"""Caches for serialized per-post vote extraction results, keyed by post id and
+content hash. LocalCache lives in a single process; SharedCache talks to a
+CacheServer sidecar over a unix socket, so every gunicorn worker on a host
+shares one cache under one memory bound.
+
+Both ends authenticate each other with a shared authkey, as the payloads are
+marshalled and marshal is not safe on untrusted data. The socket defaults to
+a directory only the current user can access.
+
+VOTETALLY_CACHE_AUTHKEY=<secret> python sharedcache.py --max-bytes 268435456
+"""
+import os, sys, time, stat, marshal, argparse, tempfile, threading
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+# Bytes held per entry on top of the key and value objects, for the
+# OrderedDict slot and link node, rounded up for table slack
+ENTRY_OVERHEAD = 100
+
+
+def entry_size(key, value):
+    return sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+
+
+def default_socket():
+    """Returns the default socket path, in $XDG_RUNTIME_DIR or a per-user
+    directory under the temporary directory. Raises OSError if that
+    directory is not private to the current user."""
+    directory = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+        tempfile.gettempdir(), "votetally-{}".format(os.getuid()))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    info = os.lstat(directory)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & 0o077):
+        raise OSError("{} is not a directory private to this user".format(
+            directory))
+
+    return os.path.join(directory, "votetally-cache.sock")
+
+
+class LocalCache(object):
+    """Byte-bounded per-process cache, evicting the least recently used items
+    first"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def get_many(self, keys):
+        """Returns a list of the values of keys, None for those missing"""
+        output = []
+        with self.lock:
+            for key in keys:
+                try:
+                    value = self.items[key]
+                except KeyError:
+                    self.misses += 1
+                    output.append(None)
+                else:
+                    self.hits += 1
+                    self.items.move_to_end(key)
+                    output.append(value)
+        return output
+
+
+    def set_many(self, items):
+        """Stores an iterable of key, value pairs, evicting to fit"""
+        with self.lock:
+            for key, value in items:
+                size = entry_size(key, value)
+                if size > self.max_bytes:
+                    continue
+
+                try:
+                    old = self.items.pop(key)
+                except KeyError:
+                    pass
+                else:
+                    self.size -= entry_size(key, old)
+
+                self.items[key] = value
+                self.size += size
+
+                while self.size > self.max_bytes:
+                    k, v = self.items.popitem(last=False)
+                    self.size -= entry_size(k, v)
+
+
+    def stats(self):
+        return {
+            "items"     : len(self.items),
+            "bytes"     : self.size,
+            "max_bytes" : self.max_bytes,
+            "hits"      : self.hits,
+            "misses"    : self.misses
+        }
+
+
+class SharedCache(object):
+    """Client for a CacheServer. Connects lazily, and again after a fork, so
+    it can be created before gunicorn forks its workers. If the server cannot
+    be reached every lookup misses, and reconnection is retried after retry
+    seconds. A wrong authkey raises AuthenticationError rather than
+    missing."""
+    def __init__(self, address, authkey, retry=5):
+        self.address = address
+        self.authkey = authkey
+        self.retry = retry
+
+        self.conn = None
+        self.pid = None
+        self.down_until = 0
+        self.lock = threading.Lock()
+
+
+    def connection(self):
+        if self.pid != os.getpid():
+            # Don't share the parent's socket with it
+            self.conn, self.pid = None, os.getpid()
+
+        if self.conn is None and time.time() >= self.down_until:
+            self.conn = Client(self.address, 'AF_UNIX', authkey=self.authkey)
+
+        return self.conn
+
+
+    def request(self, *message):
+        """Sends message to the server, returns its reply or None if the server
+        is unavailable"""
+        with self.lock:
+            try:
+                conn = self.connection()
+                if conn is None:
+                    return None
+                conn.send_bytes(marshal.dumps(message))
+                return marshal.loads(conn.recv_bytes())
+            except (OSError, EOFError):
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                self.down_until = time.time() + self.retry
+                return None
+
+
+    def get_many(self, keys):
+        return self.request("get", list(keys)) or [None for i in keys]
+
+
+    def set_many(self, items):
+        self.request("set", list(items))
+
+
+    def stats(self):
+        return self.request("stats")
+
+
+class CacheServer(object):
+    'Sidecar process holding a LocalCache for all workers on the host'
+    def __init__(self, address, max_bytes, authkey):
+        self.address = address
+        self.store = LocalCache(max_bytes)
+        self.authkey = authkey
+
+
+    def handle(self, conn):
+        try:
+            while True:
+                command, *args = marshal.loads(conn.recv_bytes())
+                if command == "get":
+                    reply = self.store.get_many(*args)
+                elif command == "set":
+                    reply = self.store.set_many(*args)
+                else:
+                    reply = self.store.stats()
+                conn.send_bytes(marshal.dumps(reply))
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        finally:
+            conn.close()
+
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        # Create the socket owner-only rather than chmod it after binding
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, 'AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+
+        with listener:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    continue
+                threading.Thread(target=self.handle, args=(conn,),
+                    daemon=True).start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--socket', help="defaults to default_socket()")
+    parser.add_argument('--max-bytes', type=int, default=256 * 1024 * 1024)
+    parser.add_argument('--authkey-file', help="file holding the authkey, "
+        "otherwise read from VOTETALLY_CACHE_AUTHKEY")
+    args = parser.parse_args(argv)
+
+    if args.authkey_file:
+        with open(args.authkey_file, 'rb') as f:
+            authkey = f.read().strip()
+    else:
+        authkey = os.environ.get("VOTETALLY_CACHE_AUTHKEY", "").encode()
+    if not authkey:
+        parser.error("an authkey is required, set VOTETALLY_CACHE_AUTHKEY or "
+            "pass --authkey-file")
+
+    CacheServer(args.socket or default_socket(), args.max_bytes,
+        authkey).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
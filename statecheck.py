@@ -0,0 +1,167 @@
+"""Checks that chaining diff_tally states through a thread's edits gives the
+same options, counts and per-voter votes as a full tally, and that each diff
+reports the changes between the full tallies before and after. Exits non-zero
+on the first mismatch.
+
+python statecheck.py --seeds 150 --steps 15
+"""
+import sys, json, random, argparse
+
+import corpus
+from voteparser import VoteContainer
+
+configs = [
+    {},
+    {"break_level": 1},
+    {"break_level": 2},
+    {"refer_dir": 1},
+    {"refer_dir": 1, "break_level": 2},
+]
+
+
+def post(n, username, message):
+    return {'username': username, 'user_id': n, 'post_id': n,
+            'message': message}
+
+
+def fixed_cases():
+    """Yields (op, posts before, posts after, config) for edits that have
+    broken incremental states"""
+    # An upward referral through a vote that a later post supersedes
+    before = [post(1, 'Bob', '[X] x\n'), post(2, 'Carol', '[X] Bob\n'),
+              post(3, 'Dan', '[X] Carol\n'), post(4, 'Carol', '[X] y\n')]
+    after = [post(1, 'Bob', '[X] z\n')] + before[1:]
+    yield 'op', before, after, {"refer_dir": 1}
+    yield 'op', before, after, {}
+
+
+def edit(rng, posts, op, n):
+    """Returns a copy of posts with a few posts added, edited, deleted or
+    given a referral, and the next free post id"""
+    posts = [dict(i) for i in posts]
+    voters = ["Voter{}".format(i) for i in range(40)] + [op]
+
+    for i in range(rng.randint(1, 4)):
+        roll = rng.random()
+        if roll < 0.4 or not posts:
+            n += 1
+            posts.append(corpus.synthetic_post(rng, n, voters, posts[-20:]))
+        elif roll < 0.7:
+            rng.choice(posts)['message'] = corpus.synthetic_post(
+                rng, 0, voters, posts[-5:])['message']
+        elif roll < 0.85:
+            posts.remove(rng.choice(posts))
+        else:
+            rng.choice(posts)['message'] += "\n[X] {}\n".format(
+                rng.choice(posts)['username'])
+
+    return posts, n
+
+
+def full_tally(VC, posts, op, config):
+    """Returns ({merge key: count}, {reduced voter: set of merge keys}) from a
+    full tally, counting each voter once per vote"""
+    VC.settings(**config)
+    votes = VC.uniq_votes_by_name(VC.extract_votes(posts), op=op.lower())
+    if VC.break_level:
+        votes = VC.break_votes(votes)
+        # break_votes shares the voter lists of a vote between its parts
+        for vote in votes:
+            for key in ("voters", "voters_reduced", "voters_full"):
+                vote[key] = list(vote[key])
+
+    counts, voters = {}, {}
+    for vote in VC.merge_votes_by_content(votes):
+        key = ''.join(vote['vote_reduced'])
+        counts[key] = len(set(vote['voters_reduced']))
+        for voter in vote['voters_reduced']:
+            voters.setdefault(voter, set()).add(key)
+
+    return counts, voters
+
+
+def expected_diff(old, new):
+    """Returns the counts of new and removed votes, the (old, new) counts of
+    changed votes and the voters who moved between two full_tally results"""
+    (old_counts, old_voters), (new_counts, new_voters) = old, new
+    return {
+        "new"     : sorted(new_counts[k] for k in new_counts
+                           if k not in old_counts),
+        "removed" : sorted(old_counts[k] for k in old_counts
+                           if k not in new_counts),
+        "counts"  : sorted((old_counts[k], new_counts[k]) for k in new_counts
+                           if k in old_counts and old_counts[k] != new_counts[k]),
+        "moved"   : len([i for i in set(old_voters) | set(new_voters)
+                         if old_voters.get(i) != new_voters.get(i)])
+    }
+
+
+def reported_diff(diff):
+    return {
+        "new"     : sorted(i["count"] for i in diff["new"]),
+        "removed" : sorted(i["count"] for i in diff["removed"]),
+        "counts"  : sorted((i["old"], i["new"]) for i in diff["counts"]),
+        "moved"   : len(diff["moved"])
+    }
+
+
+def check(VC, ref, op, steps, config, label):
+    """Chains diff_tally through each list of posts in steps, comparing every
+    state and diff with full tallies"""
+    state, previous = None, ({}, {})
+    for n, posts in enumerate(steps):
+        diff, state = VC.diff_tally(posts, op, state, **config)
+        # Round trip through JSON, as a token does
+        state = json.loads(json.dumps(state))
+        VC.check_state(state)
+
+        full = full_tally(ref, posts, op, config)
+        got = ({k: v[1] for k, v in state["options"].items()},
+               {k: set(v["options"]) for k, v in state["voters"].items()
+                if v["options"]})
+
+        for what, a, b in (("state", got, full), ("diff", reported_diff(diff),
+                           expected_diff(previous, full))):
+            if a != b:
+                print("Mismatch in {} for {} step {} with {}".format(
+                    what, label, n, config))
+                print("  diff_tally: {!r}".format(a))
+                print("  full tally: {!r}".format(b))
+                sys.exit(1)
+
+        previous = full
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seeds', type=int, default=150)
+    parser.add_argument('--steps', type=int, default=15)
+    args = parser.parse_args(argv)
+
+    VC, ref = VoteContainer(), VoteContainer()
+    checked = 0
+
+    for op, before, after, config in fixed_cases():
+        check(VC, ref, op, [before, after], config, "fixed case")
+        checked += 2
+
+    for seed in range(args.seeds):
+        rng = random.Random(seed)
+        thread = corpus.synthetic_thread(rng.choice([30, 120, 400]),
+            rng.choice([None, 8, 30]), seed)
+        op, n = thread['op'], len(thread['posts'])
+
+        steps = [thread['posts']]
+        for i in range(args.steps):
+            posts, n = edit(rng, steps[-1], op, n)
+            steps.append(posts)
+
+        for config in configs:
+            check(VC, ref, op, steps, config, "seed {}".format(seed))
+            checked += len(steps)
+
+    print("{} chained states identical to full tallies".format(checked))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
-import re, os, errno, signal
+import re, os, errno, signal, heapq, hashlib, marshal
 from functools import wraps
-from itertools import chain, groupby
-from bbcodeparser import BBCodeParser
+from itertools import chain, groupby, islice
+try:
+    from _bbcodeparser import BBCodeParser
+except ImportError:
+    from bbcodeparser import BBCodeParser
 # from difflib import get_close_matches
 from collections import OrderedDict, deque
 from string import ascii_uppercase, ascii_lowercase, punctuation, whitespace
@@ -12,6 +15,14 @@ class TimeoutError(Exception):
     pass
 
 
+class LimitError(Exception):
+    pass
+
+
+class StateError(Exception):
+    pass
+
+
 class LUOrderedDict(OrderedDict):
     'Store items in the order the keys were last added'
     def __setitem__(self, key, value):
@@ -22,17 +33,29 @@ class LUOrderedDict(OrderedDict):
 
 
 class VoteContainer(object):
-    def __init__(self, timeout=10):
+    # Bump when dump_vote's format changes
+    cache_format = 1
+    # Bump when the format of diff_tally's states changes
+    state_format = 2
+
+    def __init__(self, timeout=10, max_vote_lines=0):
         self.defaults = {
             "sim_cutoff"         : 0.95,
             "break_level"        : 0, # 0=entire vote, 1=blocks, 2=lines
             "refer_dir"          : 0, # 0=both, 1=up then both
             "vote_marker"        : "\[[Xx✅✓✓]\]", #regex
             "instant_runoff"     : 0,
-            "sort_highest"       : 0
+            "sort_highest"       : 0,
+            "limit"              : 0, # 0=all votes
+            "offset"             : 0,
+            "structured"         : 0  # 0=BBCode string, 1=list of dicts
         }
 
         self.timeout = timeout
+        self.max_vote_lines = max_vote_lines # 0=unlimited
+
+        # Optional sharedcache cache of vote_from_text results
+        self.cache = None
 
         self.BBparse = BBCodeParser()
 
@@ -44,16 +67,17 @@ class VoteContainer(object):
         self.voter_format = "[post={}]{}[/post]"
 
         self.rem_text = set(["quote", "spoiler", "s"])
-        self.rem_text_check = set(["quote", "spoiler", "[s]"])
 
         self.vote_fourple ="vote_bbcode", "vote_plain", "vote_reduced", "marker"
         self.generators = [None, self.break_blocks, self.break_lines]
 
 
     def settings(self, **kwargs):
-        """Refreshes settings"""
+        """Refreshes settings. Keys not in defaults are ignored, so that a
+        request's config cannot replace the cache, limits or other state."""
         self.__dict__.update(self.defaults)
-        self.__dict__.update(kwargs)
+        self.__dict__.update(
+            (k, v) for k, v in kwargs.items() if k in self.defaults)
         
         # if self.instant_runoff:
         #     self.vote_marker = "\[([A-Za-z]+)\]\[([0-9]+)\]"
@@ -70,16 +94,67 @@ class VoteContainer(object):
 
     def vote_from_text(self, post):
         """Extracts vote, returns a list of the parsed vote and plain text vote.
-        Tidies up BBCode. Currently ignores all quoted text."""
-        ppost = self.BBparse.parse_tags(post)
+        Tidies up BBCode. Quoted, spoilered and struck text is dropped by the
+        tokenizer. With max_vote_lines set, extraction stops one line past it,
+        enough for extract_votes to reject the post."""
+        ppost = self.BBparse.parse_tags(post, self.rem_text)
+
+        max_lines = self.max_vote_lines + 1 if self.max_vote_lines else 0
+        vote, vote_plain = self.BBparse.line_extract(
+            ppost, self.is_vote, max_lines=max_lines)
+        return vote, vote_plain
 
-        plower = post.lower()
-        rem = []
-        if any((i in plower) for i in self.rem_text_check):
-            rem = self.BBparse.index_tag_pairs(ppost, self.rem_text)
 
-        vote, vote_plain = self.BBparse.line_extract(ppost, self.is_vote, rem)
-        return vote, vote_plain
+    def cache_key(self, post):
+        """Cache key for the vote extracted from post. Covers the parser and
+        serialization versions and the settings that change vote_from_text."""
+        digest = hashlib.sha1("{}\0{}\0{}\0{}\0{}\0{}".format(
+            self.BBparse.version, self.cache_format, self.vote_marker,
+            self.max_vote_lines, ",".join(sorted(self.rem_text)),
+            post['message']).encode()).hexdigest()
+        return "{}:{}".format(post['post_id'], digest)
+
+
+    def dump_vote(self, vote):
+        """Serializes a vote_from_text result for the cache"""
+        vote_bbcode, vote_plain = vote
+        if vote_bbcode:
+            vote_bbcode = [[tuple(i) if isinstance(i, tuple) else i
+                for i in line] for line in vote_bbcode]
+        return marshal.dumps((vote_bbcode, vote_plain))
+
+
+    def load_vote(self, data):
+        """Rebuilds a vote_from_text result from dump_vote"""
+        vote_bbcode, vote_plain = marshal.loads(data)
+        if vote_bbcode:
+            Tag = self.BBparse.Tag
+            vote_bbcode = [deque(Tag(*i) if isinstance(i, tuple) else i
+                for i in line) for line in vote_bbcode]
+        return vote_bbcode, vote_plain
+
+
+    def votes_from_posts(self, post_list):
+        """Returns vote_from_text results for each post in post_list, looking
+        them up in the cache first if there is one"""
+        if self.cache is None:
+            return [self.vote_from_text(post['message']) for post in post_list]
+
+        keys = [self.cache_key(post) for post in post_list]
+        output, missed = [], []
+
+        for post, key, data in zip(post_list, keys, self.cache.get_many(keys)):
+            if data is None:
+                vote = self.vote_from_text(post['message'])
+                missed.append((key, self.dump_vote(vote)))
+            else:
+                vote = self.load_vote(data)
+            output.append(vote)
+
+        if missed:
+            self.cache.set_many(missed)
+
+        return output
 
 
     # def similar_posts(self, a, b):
@@ -98,32 +173,42 @@ class VoteContainer(object):
     def extract_votes(self, post_list):
         "Takes lists of posts, returns list of dictionaries containing votes."
         vote_list = deque()
-        for post in post_list:
-            if "#####" in post['message']:
-                continue
+        post_list = [post for post in post_list if "#####" not in post['message']]
 
-            vote_bbcode, vote_plain = self.vote_from_text(post['message'])
+        for post, (vote_bbcode, vote_plain) in zip(
+                post_list, self.votes_from_posts(post_list)):
+            if vote_plain and self.max_vote_lines and (
+                    len(vote_plain) > self.max_vote_lines):
+                raise LimitError("Post {} has more than {} vote lines.".format(
+                    post['post_id'], self.max_vote_lines))
 
             if vote_bbcode:
-                vote = {
-                    "vote_bbcode"    : vote_bbcode,
-                    "vote_plain"     : vote_plain,
-                    "voters"         : [post['username']],
-                    "voters_reduced" : [self.reduce(post['username'])],
-                    "voters_full"    : [(post['username'], post['post_id'])],
-                    "vote_reduced"   : [self.reduce(i) for i in vote_plain]
-                }
-
-                if self.break_level or self.instant_runoff:
-                    vote["marker"] = [self.vote_re.match(i) for i in vote_plain]
-                else:
-                    vote["marker"] = [None for i in vote_plain]
-
-                vote_list.append(vote)
+                vote_list.append(self.make_vote(post, vote_bbcode, vote_plain))
 
         return vote_list
 
 
+    def make_vote(self, post, vote_bbcode, vote_plain, vote_reduced=None):
+        """Returns the vote dictionary for a vote extracted from post, reducing
+        its lines unless vote_reduced is given"""
+        vote = {
+            "vote_bbcode"    : vote_bbcode,
+            "vote_plain"     : vote_plain,
+            "voters"         : [post['username']],
+            "voters_reduced" : [self.reduce(post['username'])],
+            "voters_full"    : [(post['username'], post['post_id'])],
+            "vote_reduced"   : (vote_reduced if vote_reduced is not None
+                                else [self.reduce(i) for i in vote_plain])
+        }
+
+        if self.break_level or self.instant_runoff:
+            vote["marker"] = [self.vote_re.match(i) for i in vote_plain]
+        else:
+            vote["marker"] = [None for i in vote_plain]
+
+        return vote
+
+
     def normalize_by_name(self, line, vote_dict, level = 5):
         """Recurses through vote_dict up to level times to get to the bottom of
         referral chains."""
@@ -316,21 +401,85 @@ class VoteContainer(object):
     #             key = "".join( for m in v['vote_marker'] if m == num)
 
 
+    def select_votes(self, vote_list, sort_highest, limit, offset):
+        """Applies sort_highest and the limit/offset page to vote_list. When
+        sorting with a limit, only the leading offset + limit votes are
+        selected via a heap rather than sorting the whole list. The selection
+        is made when called, only the slicing is lazy."""
+        stop = offset + limit if limit else None
+
+        if sort_highest:
+            # Ties keep their merge order, as a stable sort would
+            key = lambda x: (len(x[1]['voters']), -x[0])
+            if stop is None:
+                vote_list = sorted(enumerate(vote_list), key=key, reverse=True)
+            else:
+                vote_list = heapq.nlargest(stop, enumerate(vote_list), key=key)
+            vote_list = [vote for n, vote in vote_list]
+
+        return islice(vote_list, offset, stop)
+
+
+    def selected_votes(self, vote_list):
+        """select_votes with the current settings"""
+        return self.select_votes(
+            vote_list, self.sort_highest, self.limit, self.offset)
+
+
+    def format_vote(self, vote):
+        """Formats a single merged vote as BBCode"""
+        voters = ', '.join(
+            self.voter_format.format(pid, un)
+            for un, pid in vote['voters_full']
+        )
+        return self.vote_format.format(
+            self.BBparse.reconstruct(chain(*vote['vote_bbcode'])),
+            len(vote['voters']),
+            voters
+        )
+
+
+    def format_votes(self, vote_list):
+        """Generator, yields the formatted votes of vote_list one at a time,
+        separators included."""
+        sep = ""
+        for vote in vote_list:
+            yield sep + self.format_vote(vote)
+            sep = "\n\n"
+
+
+    def iter_format(self, vote_list):
+        """Selects the page of vote_list with the current settings, returns a
+        generator of its formatted votes as per format_votes. Later settings
+        changes do not affect the generator."""
+        return self.format_votes(self.selected_votes(vote_list))
+
+
     def final_format(self, vote_list):
-        if self.sort_highest:
-            vote_list.sort(key=lambda x: len(x['voters']), reverse=True)
+        return "".join(self.iter_format(vote_list))
+
+
+    def structure_vote(self, vote):
+        """Returns a single merged vote as a dictionary for machine consumers,
+        skipping the vote_format and voter_format strings"""
+        return {
+            "vote"        : self.BBparse.reconstruct(chain(*vote['vote_bbcode'])),
+            "lines"       : [i.strip('\n') for i in vote['vote_plain']],
+            "count"       : len(vote['voters']),
+            "voters_full" : vote['voters_full']
+        }
+
+
+    def structure_votes(self, vote_list):
+        """Generator, yields the votes of vote_list as per structure_vote"""
         for vote in vote_list:
-            voters = ', '.join(
-                self.voter_format.format(pid, un)
-                for un, pid in vote['voters_full']
-            )
-            vote['repr'] = self.vote_format.format(
-                self.BBparse.reconstruct(chain(*vote['vote_bbcode'])),
-                len(vote['voters']),
-                voters
-            )
+            yield self.structure_vote(vote)
 
-        return "\n\n".join(vote['repr'] for vote in vote_list)
+
+    def iter_structured(self, vote_list):
+        """As iter_format, but the generator yields votes as per
+        structure_vote"""
+        return self.structure_votes(self.selected_votes(vote_list))
 
 
     def pprint(self, vote_list):
@@ -341,8 +490,8 @@ class VoteContainer(object):
             print()
 
 
-    def tally_votes(self, post_list, op, **kwargs):
-        """Tallies vote"""
+    def tally_vote_list(self, post_list, op, **kwargs):
+        """Tallies vote, returns the merged vote list for formatting"""
         self.settings(**kwargs)
 
         vote_list = self.extract_votes(post_list)
@@ -357,22 +506,297 @@ class VoteContainer(object):
         else:
             vote_list = self.merge_votes_by_runoff(vote_list)
 
+        return vote_list
+
+
+    def tally_votes(self, post_list, op, **kwargs):
+        """Tallies vote. Returns a BBCode string, or a list of dictionaries if
+        structured is set."""
+        vote_list = self.tally_vote_list(post_list, op, **kwargs)
+        if self.structured:
+            return list(self.iter_structured(vote_list))
         return self.final_format(vote_list)
 
 
+    def state_config(self, op):
+        """The settings a tally state depends on, with the current settings"""
+        return {
+            "version"        : self.state_format,
+            "parser"         : self.BBparse.version,
+            "op"             : op.lower(),
+            "break_level"    : self.break_level,
+            "refer_dir"      : self.refer_dir,
+            "vote_marker"    : self.vote_marker,
+            "instant_runoff" : self.instant_runoff,
+            "rem_text"       : sorted(self.rem_text)
+        }
+
+
+    def group_posts(self, post_list, op):
+        """Groups post_list by reduced username as uniq_votes_by_name would,
+        skipping op's posts. Returns a dictionary of reduced username:
+        [digest of the user's posts, their posts], and one of post_id: index
+        in post_list."""
+        groups, position, reduced = {}, {}, {}
+        op = op.lower()
+
+        for n, post in enumerate(post_list):
+            position[post['post_id']] = n
+            username = post['username']
+            if username == op:
+                continue
+            if username not in reduced:
+                reduced[username] = self.reduce(username)
+            group = groups.setdefault(reduced[username], [hashlib.sha1(), []])
+            group[0].update("{}\0{}\0{}\0".format(
+                post['username'], post['post_id'], post['message']).encode())
+            group[1].append(post)
+
+        for group in groups.values():
+            group[0] = group[0].hexdigest()[:16]
+
+        return groups, position
+
+
+    def voter_state(self, digest, vote, lines=()):
+        """Returns the state of a voter whose posts hash to digest and whose
+        latest vote is vote, None if they have not voted, with the reduced
+        lines of all their votes. Options are filled in by diff_tally."""
+        if vote is None:
+            return {"digest": digest, "vote": None, "options": []}
+
+        return {"digest": digest, "options": [], "vote": {
+            "name"    : vote['voters'][0],
+            "post_id" : vote['voters_full'][0][1],
+            "bbcode"  : [[i if isinstance(i, str) else list(i) for i in line]
+                         for line in vote['vote_bbcode']],
+            "plain"   : vote['vote_plain'],
+            "reduced" : vote['vote_reduced'],
+            "lines"   : sorted(set(lines))
+        }}
+
+
+    def state_vote(self, voter):
+        """Rebuilds the vote dictionary of a voter_state"""
+        vote = voter["vote"]
+        Tag = self.BBparse.Tag
+        bbcode = [deque(i if isinstance(i, str) else Tag(*i) for i in line)
+                  for line in vote["bbcode"]]
+        return self.make_vote({"username": vote["name"], "post_id":
+            vote["post_id"]}, bbcode, list(vote["plain"]), list(vote["reduced"]))
+
+
+    def vote_options(self, vote):
+        """Returns a dictionary of the merge keys of the votes that vote counts
+        towards once broken per break_level, to their BBCode"""
+        if self.break_level:
+            parts = ((i[0], i[2]) for i in self.break_generator(vote))
+        else:
+            parts = [(vote["vote_bbcode"], vote["vote_reduced"])]
+
+        options = {}
+        for bbcode, reduced in parts:
+            options.setdefault(''.join(reduced), bbcode)
+        return options
+
+
+    def check_state(self, state):
+        """Raises ValueError unless state is structured as diff_tally returns
+        it, for states from untrusted tokens"""
+        def line(i):
+            return isinstance(i, str) or (isinstance(i, list) and len(i) == 4
+                and all(j is None or isinstance(j, str) for j in i))
+
+        def strings(i):
+            return isinstance(i, list) and all(isinstance(j, str) for j in i)
+
+        def voter(v):
+            if not (isinstance(v["digest"], str) and strings(v["options"]) and
+                    all(i in state["options"] for i in v["options"])):
+                return False
+            vote = v["vote"]
+            return vote is None or (isinstance(vote["name"], str) and
+                strings(vote["plain"]) and strings(vote["reduced"]) and
+                strings(vote["lines"]) and
+                isinstance(vote["bbcode"], list) and
+                len(vote["bbcode"]) == len(vote["plain"]) ==
+                len(vote["reduced"]) > 0 and
+                all(isinstance(i, list) and all(line(j) for j in i)
+                    for i in vote["bbcode"]))
+
+        try:
+            valid = (isinstance(state["config"], dict) and
+                all(isinstance(text, str) and isinstance(count, int)
+                    for text, count in state["options"].values()) and
+                all(voter(v) for v in state["voters"].values()))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            valid = False
+
+        if not valid:
+            raise ValueError("Malformed tally state")
+
+
+    def diff_tally(self, post_list, op, state=None, **kwargs):
+        """Tallies vote as a state of each voter's latest vote and the options
+        it counts towards, returns the changes since state and the new state.
+        The changes are new and removed votes, votes whose count changed, and
+        voters who moved between votes, counting each voter once per vote.
+
+        Only voters whose posts changed since state are extracted again and
+        compared. Referrals between voters are resolved again over the votes in
+        state only if a changed voter refers to or is referred to by a voter.
+        state is updated in place, and must have been made with the same
+        settings."""
+        self.settings(**kwargs)
+        config = self.state_config(op)
+
+        if state is None:
+            state = {"config": config, "voters": {}, "options": {}}
+        elif state["config"] != config:
+            raise StateError("The previous tally was made with other settings.")
+
+        old, options = state["voters"], state["options"]
+        groups, position = self.group_posts(post_list, op)
+
+        changed = [name for name, (digest, posts) in groups.items()
+                   if name not in old or old[name]["digest"] != digest]
+        changed += [name for name in old if name not in groups]
+        names = set(changed)
+
+        # Latest vote of each changed voter, as uniq_votes_by_name keeps it.
+        # With refer_dir, also the lines of every vote they made, as upward
+        # referrals resolve against votes that are later superseded.
+        fresh, lines = {}, {}
+        for vote in self.extract_votes(list(chain.from_iterable(
+                groups[name][1] for name in changed if name in groups))):
+            fresh[vote["voters_reduced"][0]] = vote
+            if self.refer_dir:
+                lines.setdefault(vote["voters_reduced"][0], set()).update(
+                    vote["vote_reduced"])
+
+        voters = {}
+        for name, (digest, posts) in groups.items():
+            if name in names:
+                voters[name] = self.voter_state(
+                    digest, fresh.get(name), lines.get(name, ()))
+            else:
+                voters[name] = old[name]
+
+        # Referrals to or from a changed voter can change other voters' votes
+        key = "lines" if self.refer_dir else "reduced"
+        before = [old[name]["vote"] for name in changed
+                  if name in old and old[name]["vote"]]
+        after = [voters[name]["vote"] for name in changed
+                 if name in voters and voters[name]["vote"]]
+        changed_lines = set(chain.from_iterable(i[key] for i in before + after))
+        refers = not changed_lines.isdisjoint(
+            name for name, v in chain(old.items(), voters.items()) if v["vote"])
+        if not refers:
+            refers = any(not names.isdisjoint(v["vote"][key])
+                         for v in voters.values() if v["vote"])
+
+        if refers:
+            if self.refer_dir:
+                # Referrals upwards see votes later superseded, so need every
+                # post extracted
+                votes = self.extract_votes(post_list)
+            else:
+                # Resolve every latest vote again, in the order of their posts
+                votes = [self.state_vote(v) for v in sorted(
+                    (v for v in voters.values() if v["vote"]),
+                    key=lambda v: position[v["vote"]["post_id"]])]
+            resolved = {i["voters_reduced"][0]: i for i in
+                self.uniq_votes_by_name(votes, op=op.lower())}
+            targets = list(voters) + [i for i in changed if i not in voters]
+        else:
+            resolved = {name: fresh[name] for name in changed if name in fresh}
+            targets = changed
+
+        diff = {"new": [], "removed": [], "counts": [], "moved": []}
+        touched = {}
+
+        for name in targets:
+            voter = voters.get(name)
+            vote = resolved.get(name)
+            new_options = self.vote_options(vote) if vote else {}
+            old_options = old[name]["options"] if name in old else []
+
+            if voter is not None:
+                voter["options"] = list(new_options)
+            if list(new_options) == old_options:
+                continue
+
+            left = [i for i in old_options if i not in new_options]
+            joined = [i for i in new_options if i not in old_options]
+            for key in left:
+                touched.setdefault(key, options[key][1])
+                options[key][1] -= 1
+            for key in joined:
+                if key not in options:
+                    touched.setdefault(key, 0)
+                    options[key] = [self.BBparse.reconstruct(
+                        chain(*new_options[key])), 0]
+                else:
+                    touched.setdefault(key, options[key][1])
+                options[key][1] += 1
+
+            if left or joined:
+                diff["moved"].append({
+                    "voter"   : vote["voters"][0] if vote
+                                else old[name]["vote"]["name"],
+                    "post_id" : vote["voters_full"][0][1] if vote else None,
+                    "from"    : [options[i][0] for i in left],
+                    "to"      : [options[i][0] for i in joined]
+                })
+
+        for key, count in touched.items():
+            text, now = options[key]
+            if now <= 0:
+                del options[key]
+                if count:
+                    diff["removed"].append({"vote": text, "count": count})
+            elif not count:
+                diff["new"].append({"vote": text, "count": now})
+            elif now != count:
+                diff["counts"].append({"vote": text, "old": count, "new": now})
+
+        state["voters"] = voters
+        return diff, state
+
+
+    def tally_votes_iter(self, post_list, op, **kwargs):
+        """Tallies vote, returns a generator of formatted votes as per
+        iter_format, or of dictionaries as per iter_structured. The page is
+        selected here; only formatting is left to the generator."""
+        vote_list = self.tally_vote_list(post_list, op, **kwargs)
+        if self.structured:
+            return self.iter_structured(vote_list)
+        return self.iter_format(vote_list)
+
+
     def _handle_timeout(self, signum, frame):
         raise TimeoutError("Tally timed out!")
 
 
-    def tally_votes_timeout(self, post_list, op, **kwargs):
+    def run_timeout(self, func, *args, **kwargs):
+        """Runs func, raising TimeoutError if it takes longer than timeout"""
         signal.signal(signal.SIGALRM, self._handle_timeout)
         signal.alarm(self.timeout)
         try:
-            result = self.tally_votes(post_list, op, **kwargs)
+            result = func(*args, **kwargs)
         finally:
             signal.alarm(0)
 
         return result
-                
 
 
+    def tally_votes_timeout(self, post_list, op, **kwargs):
+        return self.run_timeout(self.tally_votes, post_list, op, **kwargs)
+
+
+    def tally_votes_iter_timeout(self, post_list, op, **kwargs):
+        """Runs the tally and page selection under the timeout. Formatting is
+        left to the returned generator and is not covered by the timeout; an
+        error while formatting ends the output early, after the response has
+        started."""
+        return self.run_timeout(self.tally_votes_iter, post_list, op, **kwargs)